@@ -27,6 +27,53 @@ def prompt_yn(question, default=None):
             print "Please respond with 'yes' or 'no' (or 'y' or 'n')."
 
 
+def read_approvals(path):
+    """Read approval keys from a file.
+
+    The file lists one approval key per line.  Blank lines and lines starting
+    with "#" are ignored.
+    """
+    approvals = set()
+    with open(path) as approvals_file:
+        for line in approvals_file:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                approvals.add(line)
+    return approvals
+
+
+def approve_all(pending, assume_yes=False, approvals_file=None):
+    """Approve a batch of pending changes in one step.
+
+    "pending" is a list of (key, description) tuples.
+    "assume_yes" approves everything without prompting.
+    "approvals_file" is a path to a file of approved keys (see read_approvals)
+    and is used instead of prompting.
+
+    The return value is the set of approved keys, or None if any pending
+    change was not approved.
+    """
+    keys = set(key for key, _ in pending)
+    if not pending or assume_yes:
+        return keys
+
+    if approvals_file is not None:
+        approvals = read_approvals(approvals_file)
+        missing = [(key, description) for key, description in pending
+                   if key not in approvals]
+        for key, description in missing:
+            print "Not approved in {}: {} ({})".format(
+                approvals_file, key, description)
+        return None if missing else keys
+
+    lines = ["The following will be created:"]
+    lines.extend("  - {}".format(description) for _, description in pending)
+    lines.append("Do you want to create them?")
+    if prompt_yn("\n".join(lines)):
+        return keys
+    return None
+
+
 def aws2dict(lst):
     return {item['Key']: item['Value'] for item in lst}
 
@@ -4,15 +4,18 @@ import argparse
 import copy
 import json
 import logging
+import os
 import re
 import sys
+import threading
+from collections import OrderedDict
 from time import sleep
 
 import boto3
 
 from devops import region_data
 from devops.aws import arn
-from devops.utils import prompt_yn, aws2dict, dict2aws
+from devops.utils import approve_all, aws2dict, dict2aws
 
 logger = logging.getLogger()
 
@@ -23,14 +26,18 @@ class deploy_export_service(object):
     """
     Deploy ElasticBeanstalk environments for Professional Services.
 
-    This function-like class creates an "export-service" environment with a
-    standard naming convention and adds the needed permissions to the IAM role
-    to allow Delivery to change configuration and test exports by adding an
-    event to the worker SQS queue.
+    This class creates an "export-service" environment with a standard naming
+    convention and adds the needed permissions to the IAM role to allow
+    Delivery to change configuration and test exports by adding an event to
+    the worker SQS queue.
+
+    Nothing is created until setup_shared() and deploy() are called.
+    pending_shared_creations() and pending_creations() list the resources that
+    would be created so that they can be approved up front.
     """
 
-    def __init__(self, args):
-        """Deploy the export-service environment."""
+    def __init__(self, args, environment):
+        """Set up clients for the export-service environment."""
         self.session = boto3.Session(profile_name=args.profile,
                                      region_name=args.region)
         self.arn = arn.boto_arn(sess=self.session)
@@ -38,9 +45,9 @@ class deploy_export_service(object):
         self.eb_client = self.session.client('elasticbeanstalk')
         self.dynamodb_client = self.session.client('dynamodb')
         self.iam_client = self.session.client('iam')
-        self.environment = args.environment
+        self.environment = environment
         self.subenv = args.customer_name
-        env_name = "-".join([args.customer_name, args.environment])
+        env_name = "-".join([args.customer_name, environment])
         self.environment_name = env_name
         self.stackdriver_key_bucket = args.keybucket
 
@@ -53,12 +60,73 @@ class deploy_export_service(object):
             vpc = region_data.by_aws_name[args.region].dip_vpc
 
         self.vpc = self._get_vpc_details(vpc)
-        self.setup_application()
-        self.setup_environment()
+
+    @property
+    def application_approval_key(self):
+        return "application/export-service"
+
+    @property
+    def environment_approval_key(self):
+        return "environment/{}".format(self.environment_name)
+
+    def pending_shared_creations(self):
+        """
+        List the shared resources that do not exist yet and need approval to
+        create.
+
+        Returns a list of (approval key, description) tuples.
+        """
+        pending = []
+        if not self.check_for_application():
+            pending.append((
+                self.application_approval_key,
+                "application \"export-service\" in {} for account profile "
+                "\"{}\"".format(self.session.region_name,
+                                self.session.profile_name)))
+        return pending
+
+    def pending_creations(self):
+        """
+        List the environment resources that do not exist yet and need approval
+        to create.
+
+        Returns a list of (approval key, description) tuples.
+        """
+        pending = []
+        if not self.check_for_environment():
+            pending.append((
+                self.environment_approval_key,
+                "environment {} for application 'export-service' in {} for "
+                "account profile \"{}\"".format(
+                    self.environment_name, self.session.region_name,
+                    self.session.profile_name)))
+        return pending
+
+    def setup_shared(self, approved, with_security_group=False):
+        """
+        Set up the resources shared by all export-service environments.
+
+        Returns the id of the customer's security group if
+        "with_security_group" is set, otherwise None.
+        """
+        self.setup_application(approved)
         self.setup_dynamodb()
+        if with_security_group:
+            return self.create_sg()
+
+    def deploy(self, approved, security_group=None):
+        """
+        Deploy the environment, creating only approved resources.
+
+        Returns the worker queue and CloudFormation stack ARNs for the IAM
+        policy, which is updated once for all environments by
+        update_iam_polices().
+        """
+        self.setup_environment(approved, security_group)
         self.setup_beanstalk_config()
-        self.update_iam_polices()
+        resource_arns = self.get_resource_arns()
         logger.info("Done")
+        return resource_arns
 
     def _wait_on_env_status(self):
         status = "Checking"
@@ -135,9 +203,8 @@ class deploy_export_service(object):
         )
         logger.debug("create application: {}".format(response))
 
-    def create_environment(self):
+    def create_environment(self, security_group):
         """Create the environment for the customer."""
-        security_group = self.create_sg()
         tags = {'region': self.session.region_name,
                 'group': 'export-service',
                 'env': "prod",
@@ -260,6 +327,15 @@ class deploy_export_service(object):
         cf_stack = re.search('(awseb-e-.*-stack)', launch_config).group(1)
         return worker_queue, cf_stack
 
+    def get_resource_arns(self):
+        """Get the worker queue and CloudFormation stack ARNs."""
+        worker_queue, cf_stack = self.get_resources()
+        worker_queue_arn = "arn:{}:sqs:{}:{}:{}".format(
+            self.arn.partition, self.session.region_name, self.arn.account, worker_queue)
+        cf_stack_arn = "arn:{}:cloudformation:{}:{}:stack/{}/*".format(
+            self.arn.partition, self.session.region_name, self.arn.account, cf_stack)
+        return worker_queue_arn, cf_stack_arn
+
     def get_stackdriver_key(self):
         """Retrieve the Stackdriver key from s3 for instance monitoring."""
         s3_client = self.session.client('s3')
@@ -269,21 +345,18 @@ class deploy_export_service(object):
         )
         return response['Body'].read().rstrip()
 
-    def setup_application(self):
-        """Create the "export-service" environment if it does not exist."""
+    def setup_application(self, approved):
+        """Create the "export-service" application if it does not exist."""
         if self.check_for_application():
             logger.info("Application 'export-service' found")
         else:
             logger.info("export-service application not found")
-            prompt = ("Did not find application \"export-service\" in {} for "
-                      "account profile \"{}\".\nDo you want to create it?"
-                      ).format(self.session.region_name,
-                               self.session.profile_name)
-            if prompt_yn(prompt):
+            if self.application_approval_key in approved:
                 logger.info("Creating app 'export-service'")
                 self.create_application()
             else:
-                raise SystemExit("Exiting")
+                raise SystemExit("Creating application 'export-service' was "
+                                 "not approved. Exiting")
 
     def setup_beanstalk_config(self):
         """
@@ -342,35 +415,29 @@ class deploy_export_service(object):
             logger.info("export-service table created")
         return True
 
-    def setup_environment(self):
+    def setup_environment(self, approved, security_group):
         """Create the customer's environment if it does not exist."""
         if self.check_for_environment():
             logger.info("Environment {} found".format(self.environment_name))
         else:
-            prompt = ("Did not find environment {} for application "
-                      "'export-service' in {} for account profile \"{}\""
-                      ".\nDo you want to create it?").format(
-                      self.environment_name, self.session.region_name,
-                      self.session.profile_name)
-            if prompt_yn(prompt):
+            if self.environment_approval_key in approved:
                 logger.info("Creating environment: {}".format(
                     self.environment_name))
-                response = self.create_environment()
+                response = self.create_environment(security_group)
                 logger.debug("create environment: {}".format(response))
             else:
-                raise SystemExit("Exiting")
+                raise SystemExit("Creating environment {} was not approved. "
+                                 "Exiting".format(self.environment_name))
 
-    def update_iam_polices(self):
+    def update_iam_polices(self, resource_arns):
         """
         Update IAM policies to allow Delivery to configure the "export-service"
-        environment.
-        """
-        worker_queue, cf_stack = self.get_resources()
-        worker_queue_arn = "arn:{}:sqs:{}:{}:{}".format(
-            self.arn.partition, self.session.region_name, self.arn.account, worker_queue)
-        cf_stack_arn = "arn:{}:cloudformation:{}:{}:stack/{}/*".format(
-            self.arn.partition, self.session.region_name, self.arn.account, cf_stack)
+        environments.
 
+        "resource_arns" is a list of (worker queue ARN, CloudFormation stack
+        ARN) tuples, as returned by deploy().  All of them are added in a
+        single new policy version.
+        """
         policy_name = "allow-export-service-configuration"
         policy_arn, policy = self.get_current_policy(policy_name)
         if not policy:
@@ -381,16 +448,17 @@ class deploy_export_service(object):
 
         new_policy = copy.deepcopy(policy)
         for statement in new_policy['Statement']:
-            cf_actions = ['cloudformation:UpdateStack',
-                          'cloudformation:CancelUpdateStack']
-            if (statement['Action'] == cf_actions and cf_stack_arn not in
-                    statement['Resource']):
-                statement['Resource'].append(cf_stack_arn)
-
-            sqs_actions = ['sqs:SendMessage']
-            if (statement['Action'] == sqs_actions and worker_queue_arn not in
-                    statement['Resource']):
-                statement['Resource'].append(worker_queue_arn)
+            for worker_queue_arn, cf_stack_arn in resource_arns:
+                cf_actions = ['cloudformation:UpdateStack',
+                              'cloudformation:CancelUpdateStack']
+                if (statement['Action'] == cf_actions and cf_stack_arn not in
+                        statement['Resource']):
+                    statement['Resource'].append(cf_stack_arn)
+
+                sqs_actions = ['sqs:SendMessage']
+                if (statement['Action'] == sqs_actions and
+                        worker_queue_arn not in statement['Resource']):
+                    statement['Resource'].append(worker_queue_arn)
 
         if new_policy != policy:
             self.update_policy(policy_arn, new_policy)
@@ -421,12 +489,17 @@ def _parse_args(argv=None):
         help=("name of customer, used for subenv and environment name. Use "
               "no special characters and use - instead of space.  E.g. "
               "mcdonalds-consumer"))
-    parser.add_argument('environment', metavar='ENVIRONMENT',
-        help="E.g.: dev, staging, test, prod")
+    parser.add_argument('environments', metavar='ENVIRONMENT', nargs='+',
+        help="one or more environments, e.g.: dev staging test prod")
     parser.add_argument('-k', '--keybucket', default="janrain-services-keys",
         help="s3 bucket for stackdriver keys. (default: janrain-services-keys)")
     parser.add_argument('-i', '--vpc-id',
         help="vpc where export service will be deployed. (default: region's dip vpc)")
+    parser.add_argument('-y', '--yes', action='store_true',
+        help="approve creating every missing application and environment")
+    parser.add_argument('-a', '--approvals-file',
+        help=("file listing approved creations, one per line, e.g. "
+              "application/export-service or environment/CUSTOMER_NAME-ENV"))
     return parser.parse_args(argv)
 
 
@@ -434,10 +507,80 @@ def main(argv=None):
     """Run the deploy script."""
     args = _parse_args(argv)
     logging.basicConfig(stream=sys.stdout,
-                        format='%(asctime)s - %(levelname)s - %(message)s')
+                        format=('%(asctime)s - %(threadName)s - '
+                                '%(levelname)s - %(message)s'))
     logger.setLevel(args.level)
 
-    deploy_export_service(args)
+    if args.approvals_file and not os.path.isfile(args.approvals_file):
+        raise SystemExit("Approvals file not found: {}".format(
+            args.approvals_file))
+
+    deployers = [deploy_export_service(args, env)
+                 for env in OrderedDict.fromkeys(args.environments)]
+
+    # Gather every pending creation before anything is changed so that the
+    # whole run is approved at once and the deploy threads never prompt.
+    pending = deployers[0].pending_shared_creations()
+    for deployer in deployers:
+        pending.extend(deployer.pending_creations())
+    approved = approve_all(pending, assume_yes=args.yes,
+                           approvals_file=args.approvals_file)
+    if approved is None:
+        raise SystemExit("Exiting")
+
+    # Shared resources are set up here, before any deploy thread starts, so
+    # the threads never race to create them.
+    creating_environments = any(
+        deployer.environment_approval_key in approved
+        for deployer in deployers)
+    security_group = deployers[0].setup_shared(
+        approved, with_security_group=creating_environments)
+
+    failed = []
+    resource_arns = {}
+
+    def run(deployer):
+        try:
+            resource_arns[deployer.environment_name] = deployer.deploy(
+                approved, security_group)
+        except BaseException:
+            logger.exception("Deploying {} failed".format(
+                deployer.environment_name))
+            failed.append(deployer.environment_name)
+
+    threads = [threading.Thread(target=run, args=(deployer,),
+                                name=deployer.environment_name)
+               for deployer in deployers]
+    for thread in threads:
+        # daemon threads and a join timeout let Ctrl-C end the run
+        thread.daemon = True
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+    except KeyboardInterrupt:
+        running = [thread.name for thread in threads if thread.is_alive()]
+        logger.error("Interrupted while deploying: {}".format(
+            ", ".join(running)))
+        if failed:
+            logger.error("Failed to deploy: {}".format(", ".join(failed)))
+        if resource_arns:
+            logger.error("IAM policy not updated for: {}".format(
+                ", ".join(resource_arns)))
+        raise SystemExit("Interrupted. These environments may be partially "
+                         "configured: {}".format(", ".join(running + failed)))
+
+    # The IAM policy is account-wide, so it is updated once for every
+    # environment that deployed instead of once per thread.
+    if resource_arns:
+        deployers[0].update_iam_polices(
+            [resource_arns[deployer.environment_name]
+             for deployer in deployers
+             if deployer.environment_name in resource_arns])
+
+    if failed:
+        raise SystemExit("Failed to deploy: {}".format(", ".join(failed)))
 
 if __name__ == "__main__":
     main()